@@ -1,20 +1,26 @@
 """
 Create backup for certain date for specified channel in slack
 """
+import collections
+from concurrent import futures
 from datetime import datetime
 import getpass
 import json
 import logging
 import os
 import pprint
+import queue
+import threading
 import uuid
 
 import slackclient
+import sqlalchemy
 import sqlalchemy.orm.exc
 
 from slack_backup import db
 from slack_backup import objects as o
 from slack_backup import download
+from slack_backup import ratelimit
 from slack_backup import reporters
 from slack_backup import utils
 
@@ -25,10 +31,14 @@ class Client(object):
     querying data fetched out using Slack API.
     """
     RAW = '%Y%m%d%H%M%S_{name}.json'
+    # Number of queued downloads processed before results are committed
+    DOWNLOAD_BATCH = 100
 
     def __init__(self, args):
         if 'token' in args:
             self.slack = slackclient.SlackClient(args.token)
+            self.scheduler = ratelimit.Scheduler(self.slack)
+        if 'user' in args:
             self.user = args.user
             self.password = args.password
             if not self.user and not self.password:
@@ -42,8 +52,12 @@ class Client(object):
                                                 'your slack account: ')
             dbpath = self._get_asset_dir(args.database)
             self.downloader = download.Download(args, dbpath)
-        self.engine = db.connect(args.database)
-        self.session = db.Session()
+        self.engine = db.connect(args.database,
+                                 args.db_profile if 'db_profile' in args
+                                 else None)
+        # Client is the only writer to the DB, so there is no need to refresh
+        # objects (like channels or cached users) after every commit.
+        self.session = db.Session(expire_on_commit=False)
         self.selected_channels = args.channels
         self.q = self.session.query
 
@@ -60,19 +74,31 @@ class Client(object):
         if 'url_file_to_attachment' in args:
             self._url_file_to_attachment = args.url_file_to_attachment
 
+        self._jobs = 1
+        if 'jobs' in args and args.jobs:
+            self._jobs = args.jobs
+
         self._dlpath = utils.get_temp_name(dir=os.path.curdir,
                                            prefix='manual_download_',
                                            unlink=True)
         self._dldata = []
+        # slackid -> User identity map and list of bot ids, which cannot be
+        # found by the API.
+        self._users = {}
+        self._missing_bots = set()
 
     def update(self):
         """
         Perform an update, store data to db
         """
-        self.downloader.authorize()
+        if not self.downloader.defer:
+            self.downloader.authorize()
         self.update_users()
         self.update_channels()
         self.update_history()
+        self.downloader.wait()
+        self._record_downloads()
+        self._log_download_stats()
         self._finalize()
 
     def update_channels(self):
@@ -114,67 +140,122 @@ class Client(object):
             user = self.q(o.User).\
                 filter(o.User.slackid == user_data['id']).one_or_none()
 
+            avatar_hash = None
             if user:
+                avatar_hash = user.profile.avatar_hash
                 user.update(user_data)
             else:
                 user = o.User(user_data)
                 self.session.add(user)
                 self.session.flush()
 
-            if user.profile.image_original:
-                user.profile.image_path = self.downloader.\
-                    download(user.profile.image_original, 'avatar')
+            self._sync_avatar(user.profile, avatar_hash)
 
         self.session.commit()
 
+    def _sync_avatar(self, profile, avatar_hash):
+        """
+        Download the avatar, unless its hash is the same as before and
+        it's already downloaded. Otherwise, if there is an old copy, ask for
+        it conditionally.
+        """
+        if not profile.image_original:
+            return
+
+        downloaded = profile.image_path and os.path.exists(profile.image_path)
+        if downloaded and avatar_hash and avatar_hash == profile.avatar_hash:
+            logging.debug("Avatar for `%s' is up to date", profile.real_name)
+            return
+
+        etag = modified = None
+        if downloaded:
+            etag = profile.avatar_etag
+            modified = profile.avatar_modified
+
+        profile.image_path = self.downloader.download(profile.image_original,
+                                                      'avatar', etag=etag,
+                                                      modified=modified)
+
     def update_history(self):
         """
         Get the latest or all messages out of optionally selected channels
         """
         logging.info("Fetching and storing messages in DB")
 
-        all_channels = self.q(o.Channel).all()
+        self._users = {user.slackid: user for user in self.q(o.User).all()}
+        self._load_assets()
+
+        all_channels = self.q(o.Channel).\
+            options(sqlalchemy.orm.joinedload(o.Channel.checkpoint)).all()
         if self.selected_channels:
             channels = [c for c in all_channels
                         if c.name in self.selected_channels]
         else:
             channels = all_channels
 
+        latest_ts = self._get_latest_timestamps()
+
+        work = []
         for channel in channels:
-            logging.info("Getting messages for channel `%s'", channel.name)
-            latest = self.q(o.Message).\
-                filter(o.Message.channel == channel).\
-                order_by(o.Message.ts.desc()).first()
+            if channel.checkpoint and channel.checkpoint.cursor:
+                # continue exactly where last fetch has stopped
+                work.append((channel, channel.checkpoint.cursor))
+                continue
+
             # NOTE(gryf): Trick out the API, which by default (latest and
             # oldest parameters set to 0) return certain amount of latest
             # messages, while we'd like to have it from the beginning of the
             # available history, if there is no database records available. In
             # that case value of 1 here will force the API to get messages
             # starting from first January 1970.
-            latest = latest and latest.ts or 1
-
-            result = []
-            while True:
-                logging.debug("Fetching another portion of messages")
-                messages, latest = self._channels_history(channel, latest)
-                if messages is None:
-                    # ignore deleted channels
-                    break
+            work.append((channel, latest_ts.get(channel.id) or 1))
 
-                result.extend(messages)
-
-                for msg in messages:
-                    self._create_message(msg, channel)
-
-                if latest is None:
-                    break
-
-            if self._raw_fname:
-                with open(self._raw_fname.format(name='channel-' +
-                                                 channel.name), 'w') as fobj:
-                    fobj.write(json.dumps(result))
+        if self._jobs > 1:
+            pages = self._fetch_parallel(work)
+        else:
+            pages = self._fetch_serial(work)
 
-        self.session.commit()
+        # All of the DB writes happens here, in the calling thread, no matter
+        # how many workers are fetching the pages. Every page is stored and
+        # written to the raw file (if requested) as soon as it arrives, so
+        # that nothing but the current page is kept in memory.
+        raw = {}
+        try:
+            for channel, page in pages:
+                if page is None:
+                    # all pages for the channel was fetched
+                    self._complete_checkpoint(channel)
+                    if self._raw_fname:
+                        self._get_raw_writer(raw, channel).close()
+                        del raw[channel.slackid]
+                    continue
+
+                messages, cursor = page
+                self._store_messages(messages, channel, cursor)
+
+                if self._raw_fname:
+                    self._get_raw_writer(raw, channel).extend(messages)
+        finally:
+            for writer in raw.values():
+                writer.close()
+
+    def _get_latest_timestamps(self):
+        """
+        Return dictionary of channel id and the timestamp of the newest
+        message stored for it. It's done in single query, where the maximum
+        is looked up on (channel_id, ts) index for every channel.
+        """
+        latest = sqlalchemy.select([sqlalchemy.func.max(o.Message.ts)]).\
+            where(o.Message.channel_id == o.Channel.id).\
+            correlate(o.Channel.__table__).as_scalar()
+        return dict(self.q(o.Channel.id, latest).all())
+
+    def _get_raw_writer(self, writers, channel):
+        """Return (and create if needed) raw file writer for the channel"""
+        if channel.slackid not in writers:
+            fname = self._raw_fname.format(name='channel-' + channel.name)
+            writers[channel.slackid] = utils.JSONListWriter(fname)
+        return writers[channel.slackid]
 
     def generate_history(self):
         """
@@ -189,41 +270,65 @@ class Client(object):
         since bots are not returned by user.list API method.
         """
         try:
-            return self.q(o.User).filter(o.User.slackid == data['user']).one()
+            return self._get_cached_user(data['user'])
         except KeyError:
             pass
 
         try:
-            return self.q(o.User).filter(o.User.slackid ==
-                                         data['comment']['user']).one()
+            return self._get_cached_user(data['comment']['user'])
         except KeyError:
             pass
 
         try:
-            return self.q(o.User).filter(o.User.slackid ==
-                                         data['bot_id']).one()
+            bot_id = data['bot_id']
         except KeyError:
             pass
-        except sqlalchemy.orm.exc.NoResultFound:
-            result = self.slack.api_call('bots.info', bot=data['bot_id'])
-            if not result.get("ok"):
-                logging.error(result['error'])
+        else:
+            if bot_id in self._missing_bots:
                 return None
+            try:
+                return self._get_cached_user(bot_id)
+            except sqlalchemy.orm.exc.NoResultFound:
+                return self._create_bot(bot_id)
 
-            user = o.User(result['bot'])
-            user.real_name = result['bot']['name']
-            self.session.add(user)
-            self.session.flush()
+        logging.exception('Failed on data: %s', pprint.pformat(data))
+        raise ValueError('Cannot identify user out of given data.')
 
-            if self._raw_fname:
-                with open(self._raw_fname.format(name='bot-' + user.slackid),
-                          "w") as fobj:
-                    fobj.write(json.dumps(result))
+    def _get_cached_user(self, slackid):
+        """
+        Return User object for provided slackid. Users are kept in the
+        identity map, so that the DB is queried only for the users which are
+        not there yet.
+        """
+        user = self._users.get(slackid)
+        if user is None:
+            user = self.q(o.User).filter(o.User.slackid == slackid).one()
+            self._users[slackid] = user
+        return user
 
-            return user
+    def _create_bot(self, bot_id):
+        """
+        Create User object out of bot information, return None if bot cannot
+        be found.
+        """
+        result = self.scheduler.api_call('bots.info', bot=bot_id)
+        if not result.get("ok"):
+            logging.error(result['error'])
+            self._missing_bots.add(bot_id)
+            return None
 
-        logging.exception('Failed on data: %s', pprint.pformat(data))
-        raise ValueError('Cannot identify user out of given data.')
+        user = o.User(result['bot'])
+        user.real_name = result['bot']['name']
+        self.session.add(user)
+        self.session.flush()
+        self._users[bot_id] = user
+
+        if self._raw_fname:
+            with open(self._raw_fname.format(name='bot-' + user.slackid),
+                      "w") as fobj:
+                fobj.write(json.dumps(result))
+
+        return user
 
     def _create_message(self, data, channel):
         """
@@ -244,9 +349,12 @@ class Client(object):
                          user.name)
             return
 
+        # NOTE(gryf): Message is not bound to the session, nor to the channel
+        # or user objects, since it will be stored using bulk insert. Only
+        # the ids are copied.
         message = o.Message(data)
-        message.channel = channel
-        message.user = user
+        message.channel_id = channel.id
+        message.user_id = user and user.id
 
         if data.get('is_starred'):
             message.is_starred = True
@@ -281,7 +389,222 @@ class Client(object):
         elif data.get('attachments'):
             self._att_data(message, data['attachments'])
 
-        self.session.add(message)
+        return message
+
+    def _store_messages(self, messages, channel, cursor=None):
+        """
+        Create messages out of the portion of messages data and store them
+        along with reactions, files and attachments using bulk inserts.
+        Messages which already exists in the channel (with the same ts) are
+        ignored, together with their related objects. Channel checkpoint is
+        moved to the provided cursor within the same transaction, so that the
+        fetch can be resumed from the last committed page.
+        """
+        rows = collections.OrderedDict((klass, []) for klass in
+                                       (o.Message, o.Reaction, o.File,
+                                        o.Attachment))
+
+        # Since there is only one writer, ids for the messages can be given
+        # upfront, so that there is no need to query for them to bind the
+        # related objects.
+        first_id = self.q(sqlalchemy.func.max(o.Message.id)).scalar() or 0
+        message_id = first_id
+
+        for data in messages:
+            message = self._create_message(data, channel)
+            if not message:
+                continue
+
+            message_id += 1
+            rows[o.Message].append(self._get_row(message, id=message_id))
+            for attr, klass in (('reactions', o.Reaction),
+                                ('files', o.File),
+                                ('attachments', o.Attachment)):
+                for obj in getattr(message, attr):
+                    rows[klass].append(self._get_row(obj,
+                                                     message_id=message_id))
+
+        if rows[o.Message]:
+            # NOTE(gryf): "OR IGNORE" is the sqlite conflict clause, which
+            # skip the rows violating unique (channel_id, ts) constraint.
+            self.session.execute(o.Message.__table__.insert().
+                                 prefix_with('OR IGNORE'), rows.pop(o.Message))
+            stored = set(id_ for id_, in self.q(o.Message.id).
+                         filter(o.Message.id > first_id))
+            if len(stored) < message_id - first_id:
+                logging.debug("Skipped %d already stored messages",
+                              message_id - first_id - len(stored))
+
+            for klass, values in rows.items():
+                values = [row for row in values
+                          if row['message_id'] in stored]
+                if values:
+                    self.session.execute(klass.__table__.insert(), values)
+
+        if cursor is not None:
+            self._update_checkpoint(channel, cursor)
+
+        self._record_downloads(commit=False)
+        self.session.commit()
+
+    def _record_downloads(self, commit=True):
+        """
+        Update files with the results of finished downloads, store new
+        entries in the assets index and deferred downloads in the queue.
+        Return the results.
+        """
+        queued = self.downloader.get_queued()
+        if queued:
+            self.session.execute(o.QueuedDownload.__table__.insert().
+                                 prefix_with('OR IGNORE'), queued)
+
+        results = self.downloader.get_results()
+        if results:
+            self._store_results(results)
+
+        if commit and (queued or results):
+            self.session.commit()
+
+        return results
+
+    def _store_results(self, results):
+        """Store results of the downloads"""
+        files = o.File.__table__
+        update = files.update().\
+            where(files.c.filepath == sqlalchemy.bindparam('_path')).\
+            values(filepath=sqlalchemy.bindparam('_final'),
+                   status=sqlalchemy.bindparam('_status'),
+                   sha256=sqlalchemy.bindparam('_sha256'),
+                   size=sqlalchemy.bindparam('_size'))
+        self.session.execute(update, [{'_path': res.path,
+                                       '_final': res.final,
+                                       '_status': res.status,
+                                       '_sha256': res.sha256,
+                                       '_size': res.size}
+                                      for res in results])
+
+        validators = [{'_url': res.url, '_etag': res.etag,
+                       '_modified': res.modified}
+                      for res in results if res.etag or res.modified]
+        if validators:
+            profiles = o.UserProfile.__table__
+            update = profiles.update().\
+                where(profiles.c.image_original ==
+                      sqlalchemy.bindparam('_url')).\
+                values(avatar_etag=sqlalchemy.bindparam('_etag'),
+                       avatar_modified=sqlalchemy.bindparam('_modified'))
+            self.session.execute(update, validators)
+
+        assets = [{'url': res.url, 'sha256': res.sha256, 'size': res.size,
+                   'path': res.final} for res in results if res.sha256]
+        if assets:
+            self.session.execute(o.Asset.__table__.insert().
+                                 prefix_with('OR IGNORE'), assets)
+
+    def _load_assets(self):
+        """Pass downloaded and queued assets to the downloader"""
+        self.downloader.add_assets(self.q(o.Asset.url, o.Asset.sha256,
+                                          o.Asset.size, o.Asset.path))
+        self.downloader.add_queued(self.q(o.QueuedDownload.url,
+                                          o.QueuedDownload.path))
+
+    def download_assets(self):
+        """
+        Download files and avatars queued by the fetch in deferred mode.
+        Queue is processed in batches, ordered by the host and size of the
+        files, so that the biggest files are started first, and the
+        connections to the same host can be reused.
+        """
+        self.downloader.authorize()
+        self._load_assets()
+
+        queue = o.QueuedDownload
+        entries = self.q(queue).order_by(queue.host, queue.size.desc(),
+                                         queue.id).all()
+        if not entries:
+            logging.info("There is nothing to download")
+            return
+
+        total = len(entries)
+        total_size = sum(entry.size or 0 for entry in entries)
+        done = failed = size = 0
+
+        for start in range(0, total, self.DOWNLOAD_BATCH):
+            for entry in entries[start:start + self.DOWNLOAD_BATCH]:
+                self.downloader.fetch(entry.url, entry.filetype, entry.path,
+                                      entry.etag, entry.modified)
+            self.downloader.wait()
+
+            results = self._record_downloads(commit=False)
+            finished = [res.path for res in results
+                        if res.status != 'failed']
+            if finished:
+                self.session.query(queue).\
+                    filter(queue.path.in_(finished)).\
+                    delete(synchronize_session=False)
+            self.session.commit()
+
+            done += len(finished)
+            failed += len(results) - len(finished)
+            size += sum(res.size or 0 for res in results)
+            logging.info("Downloaded %d of %d files (%d failed), %.1f of "
+                         "%.1f MiB", done, total, failed, size / 1048576,
+                         total_size / 1048576)
+
+        if failed:
+            logging.warning("%d files failed to download, they will be "
+                            "retried on the next run", failed)
+        self._log_download_stats()
+
+    def _log_download_stats(self):
+        """Log how well the connections were reused by the downloads"""
+        requests_num, connections = self.downloader.get_stats()
+        if requests_num:
+            logging.info("Made %d download requests using %d connections",
+                         requests_num, connections)
+
+    def _update_checkpoint(self, channel, cursor):
+        """Record cursor for the next portion of messages for the channel"""
+        checkpoint = channel.checkpoint
+        if not checkpoint:
+            checkpoint = o.Checkpoint()
+            channel.checkpoint = checkpoint
+            self.session.add(checkpoint)
+
+        if checkpoint.complete:
+            # new fetch for the channel have been started
+            checkpoint.complete = False
+            checkpoint.page = 0
+
+        checkpoint.cursor = cursor
+        checkpoint.page = (checkpoint.page or 0) + 1
+        checkpoint.updated = datetime.now()
+
+    def _complete_checkpoint(self, channel):
+        """Mark channel as completely fetched"""
+        if not channel.checkpoint or channel.checkpoint.complete:
+            return
+
+        channel.checkpoint.complete = True
+        channel.checkpoint.updated = datetime.now()
+        self.session.commit()
+
+    def _get_row(self, obj, **kwargs):
+        """
+        Return dictionary with column values of the provided object, suitable
+        for the insert statement. Column defaults are applied for the empty
+        values, and kwargs are overriding the values taken from the object.
+        """
+        row = {}
+        for column in obj.__table__.columns:
+            if column.primary_key:
+                continue
+            value = getattr(obj, column.key)
+            if value is None and column.default is not None:
+                value = column.default.arg
+            row[column.key] = value
+        row.update(kwargs)
+        return row
 
     def _file_data(self, message, data):
         """
@@ -313,9 +636,10 @@ class Client(object):
                           data['url_private_download'])
             priv_url = data['url_private_download']
             _file.filepath = self.downloader.download(priv_url, 'file',
-                                                      data.get('filetype'))
-
-        self.session.add(_file)
+                                                      data.get('filetype'),
+                                                      size=data.get('size'))
+            if _file.filepath:
+                _file.status = 'pending'
 
     def _att_data(self, message, data):
         """
@@ -383,7 +707,7 @@ class Client(object):
         Get channel list using Slack API. Return list of channel data or None
         in case of error.
         """
-        result = self.slack.api_call("channels.list")
+        result = self.scheduler.api_call("channels.list")
 
         if not result.get("ok"):
             logging.error(result['error'])
@@ -397,7 +721,7 @@ class Client(object):
         in case of error.
         """
         logging.info("Fetching and updating user information in DB")
-        result = self.slack.api_call("users.list")
+        result = self.scheduler.api_call("users.list")
 
         if not result.get("ok"):
             logging.error(result['error'])
@@ -405,7 +729,7 @@ class Client(object):
 
         return result['members']
 
-    def _channels_history(self, channel, latest):
+    def _channels_history(self, channel_id, latest):
         """
         Get list of messages using Slack API. Return tuple containing:
          - list of messages data and returned timestramp if has_more is set
@@ -413,9 +737,9 @@ class Client(object):
          - list of messages data and None if has_more is set to false,
          - empty list and None if there is no messages
         """
-        result = self.slack.api_call("channels.history",
-                                     channel=channel.slackid, count=1000,
-                                     oldest=latest)
+        result = self.scheduler.api_call("channels.history",
+                                         channel=channel_id, count=1000,
+                                         oldest=latest)
 
         if not result.get("ok"):
             logging.error(result['error'])
@@ -431,6 +755,91 @@ class Client(object):
 
         return [], None
 
+    def _channel_pages(self, name, channel_id, latest):
+        """
+        Generator for the portions of messages for the channel, starting from
+        provided timestamp. Tuples of messages list and the cursor for the next
+        portion are yielded. It doesn't touch the DB, so that it is safe to use
+        it in the worker threads.
+        """
+        logging.info("Getting messages for channel `%s'", name)
+
+        while True:
+            logging.debug("Fetching another portion of messages")
+            messages, cursor = self._channels_history(channel_id, latest)
+            if messages is None:
+                # ignore deleted channels
+                break
+
+            if cursor is None:
+                # That was the last portion. Keep the newest timestamp as a
+                # cursor, so that the next fetch will start right after it.
+                yield messages, messages and messages[0]['ts'] or latest
+                break
+
+            yield messages, cursor
+            latest = cursor
+
+    def _fetch_serial(self, work):
+        """
+        Yield tuples of channel and page (messages list and cursor) for every
+        channel one after another. When channel is exhausted, tuple with
+        channel and None is yielded.
+        """
+        for channel, latest in work:
+            for page in self._channel_pages(channel.name, channel.slackid,
+                                            latest):
+                yield channel, page
+            yield channel, None
+
+    def _fetch_parallel(self, work):
+        """
+        Same as _fetch_serial, but pages are fetched by the pool of workers,
+        several channels at once. Pages are passed back through the bounded
+        queue, so that the caller (and the only DB writer) is not flooded with
+        the data, if it can't keep up with the workers.
+        """
+        pages = queue.Queue(maxsize=self._jobs * 2)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def fetch(index, name, channel_id, latest):
+            try:
+                for page in self._channel_pages(name, channel_id, latest):
+                    if stop.is_set():
+                        return
+                    put((index, page))
+            finally:
+                put((index, None))
+
+        # Channel attributes are read here, so that workers will not need to
+        # reach the session, which can be used only by the current thread.
+        with futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            jobs = [executor.submit(fetch, index, channel.name,
+                                    channel.slackid, latest)
+                    for index, (channel, latest) in enumerate(work)]
+            try:
+                remaining = len(jobs)
+                while remaining:
+                    index, page = pages.get()
+                    if page is None:
+                        remaining -= 1
+                    yield work[index][0], page
+            finally:
+                stop.set()
+                for job in jobs:
+                    job.cancel()
+
+        for job in jobs:
+            job.result()
+
     def _finalize(self):
         """Create misc files if necessary - like manual donwload"""
         if not self._dldata:
@@ -62,6 +62,12 @@ def fetch_data(args):
     slack.update()
 
 
+def download_assets(args):
+    """Download deferred files"""
+    slack = client.Client(args)
+    slack.download_assets()
+
+
 def main():
     """Main function"""
     parser = argparse.ArgumentParser()
@@ -94,6 +100,11 @@ def main():
                        help='Path to the database file.')
     fetch.add_argument('-i', '--config', default=None,
                        help='Use specific config file.')
+    fetch.add_argument('--db-profile', default=None,
+                       choices=('safe', 'performance'),
+                       help='SQLite settings to use. Default is performance,'
+                       ' which use write-ahead log, bigger cache and memory '
+                       'mapped I/O.')
     fetch.add_argument('-r', '--raw-dir', default=None,
                        help='Write raw responses to provided directory.')
     fetch.add_argument('-f', '--url-file-to-attachment', default=False,
@@ -103,8 +114,53 @@ def main():
                        'be file created in current directory with url and '
                        'path to the filename under which it would be '
                        'registered in the DB.')
+    fetch.add_argument('-j', '--jobs', default=None, type=int,
+                       help='Number of channels which history will be '
+                       'fetched at once. Default is 1.')
+    fetch.add_argument('-J', '--download-jobs', default=None, type=int,
+                       help='Number of files and avatars downloaded in the '
+                       'background at once. Value of 0 turns off background '
+                       'downloads. Default is 4.')
+    fetch.add_argument('--download-chunk-size', default=None, type=int,
+                       help='Size of the blocks in which downloaded files '
+                       'are written, in bytes. Default is 1048576.')
+    fetch.add_argument('-D', '--defer-downloads', default=None,
+                       action='store_true',
+                       help='Do not download files and avatars, only queue '
+                       'them for the download command.')
     fetch.set_defaults(func=fetch_data)
 
+    download = subparser.add_parser('download', help='Download files and '
+                                    'avatars queued by the fetch with '
+                                    '--defer-downloads')
+    download.add_argument('-u', '--user', default=None, help='Username for '
+                          'your Slack account')
+    download.add_argument('-p', '--password', default=None, help='Password '
+                          'for your Slack account.')
+    download.add_argument('-e', '--team', default=None, help='Team name, '
+                          'which is part of slack url.')
+    download.add_argument('-v', '--verbose', help='Be verbose. Adding more '
+                          '"v" will increase verbosity', action="count",
+                          default=None)
+    download.add_argument('-q', '--quiet', help='Be quiet. Adding more "q" '
+                          'will decrease verbosity', action="count",
+                          default=None)
+    download.add_argument('-d', '--database', default=None,
+                          help='Path to the database file.')
+    download.add_argument('-i', '--config', default=None,
+                          help='Use specific config file.')
+    download.add_argument('--db-profile', default=None,
+                          choices=('safe', 'performance'),
+                          help='SQLite settings to use. Default is '
+                          'performance.')
+    download.add_argument('-J', '--download-jobs', default=None, type=int,
+                          help='Number of files downloaded at once. Default '
+                          'is 4.')
+    download.add_argument('--download-chunk-size', default=None, type=int,
+                          help='Size of the blocks in which downloaded files '
+                          'are written, in bytes. Default is 1048576.')
+    download.set_defaults(func=download_assets)
+
     generate = subparser.add_parser('generate', help='Generate logs out of '
                                     'data in provided database')
     generate.add_argument('-o', '--output', default=None, help="Output "
@@ -132,6 +188,11 @@ def main():
                           help='Path to the database file.')
     generate.add_argument('-i', '--config', default=None,
                           help='Use specific config file.')
+    generate.add_argument('--db-profile', default=None,
+                          choices=('safe', 'performance'),
+                          help='SQLite settings to use. Default is '
+                          'performance, which use write-ahead log, bigger '
+                          'cache and memory mapped I/O.')
     generate.set_defaults(func=generate_raport)
 
     args = parser.parse_args()
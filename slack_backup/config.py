@@ -12,12 +12,18 @@ import configparser
 class Config(object):
     """Configuration keeper"""
 
-    ints = ['verbose', 'quiet']
-    bools = ['url_file_to_attachment']
+    ints = ['verbose', 'quiet', 'jobs', 'download_jobs',
+            'download_chunk_size']
+    bools = ['url_file_to_attachment', 'defer_downloads']
 
-    sections = {'common': ['channels', 'database', 'quiet', 'verbose'],
+    sections = {'common': ['channels', 'database', 'quiet', 'verbose',
+                           'db_profile'],
                 'fetch': ['user', 'password', 'team', 'token',
-                          'url_file_to_attachment', 'raw_dir'],
+                          'url_file_to_attachment', 'raw_dir', 'jobs',
+                          'download_jobs', 'download_chunk_size',
+                          'defer_downloads'],
+                'download': ['user', 'password', 'team', 'download_jobs',
+                             'download_chunk_size'],
                 'generate': ['output', 'format', 'theme']}
 
     def __init__(self):
@@ -29,6 +35,7 @@ class Config(object):
         self.cp = configparser.ConfigParser()
         self._options = {'channels': [],
                          'database': None,
+                         'db_profile': 'performance',
                          'quiet': 0,
                          'verbose': 0,
                          'user': None,
@@ -39,7 +46,11 @@ class Config(object):
                          'format': None,
                          'theme': None,
                          'url_file_to_attachment': False,
-                         'raw_dir': None}
+                         'raw_dir': None,
+                         'jobs': 1,
+                         'download_jobs': 4,
+                         'download_chunk_size': 1048576,
+                         'defer_downloads': False}
         # This message supposed to be displayed in INFO level. During the time
         # of running the code where it should be displayed there is no
         # complete information about logging level. Displaying message is
@@ -81,15 +92,17 @@ class Config(object):
                 continue
 
             for option in self.sections[section]:
+                default = self._options[option]
                 if option in self.ints:
-                    val = self.cp.getint(section, option, fallback=0)
+                    val = self.cp.getint(section, option, fallback=default)
                 elif option in self.bools:
-                    val = self.cp.getboolean(section, option, fallback=False)
+                    val = self.cp.getboolean(section, option,
+                                             fallback=default)
                 elif option == 'channels':
                     val = self.cp.get(section, option, fallback='[]')
                     val = json.loads(val)
                 else:
-                    val = self.cp.get(section, option, fallback=None)
+                    val = self.cp.get(section, option, fallback=default)
 
                 self._options[option] = val
 
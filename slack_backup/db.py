@@ -3,24 +3,42 @@ Common db functions
 """
 import logging
 
-from sqlalchemy import MetaData, create_engine
+import sqlalchemy
+from sqlalchemy import MetaData, create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+from slack_backup import utils
+
 
 # Prepare SQLAlchemy objects
 Meta = MetaData()
 Base = declarative_base(metadata=Meta)
 Session = sessionmaker()
 DbFilename = None
+# Number of rows processed at once during data migrations
+BATCH = 10000
+# Pragmas applied on every connection to the database. The "safe" profile
+# keeps sqlite defaults (rollback journal, full synchronous mode), while the
+# "performance" one use write-ahead log, which is still safe with normal
+# synchronous mode, bigger page cache and memory mapped I/O.
+PROFILES = {'safe': (),
+            'performance': (('journal_mode', 'WAL'),
+                            ('synchronous', 'NORMAL'),
+                            ('mmap_size', 268435456),
+                            ('cache_size', -65536),
+                            ('temp_store', 'MEMORY'))}
+DEFAULT_PROFILE = 'performance'
 
 
-def connect(filename=None):
+def connect(filename=None, profile=None):
     """
     create engine and bind to Meta object.
     Arguments:
         @filename - string with absolute or relative path to sqlite database
                     file. If None, db in-memory will be created
+        @profile - name of the performance profile (see PROFILES) to apply on
+                   the connections. If None, default one will be used.
     """
     global DbFilename
 
@@ -33,6 +51,108 @@ def connect(filename=None):
 
     connect_string = "sqlite:///%s" % filename
     engine = create_engine(connect_string)
+    _set_profile(engine, profile or DEFAULT_PROFILE)
     Meta.bind = engine
+    Session.configure(bind=engine)
     Meta.create_all(checkfirst=True)
+    migrate(engine)
     return engine
+
+
+def _set_profile(engine, profile):
+    """Apply pragmas from the profile on every new connection"""
+    pragmas = PROFILES[profile]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+def migrate(engine):
+    """
+    Bring existing database up to date with the models. Tables are created by
+    create_all, but it will not touch the existing ones, so that missing
+    columns and indexes are added here, and new columns are filled with the
+    data, if needed.
+    """
+    inspector = sqlalchemy.inspect(engine)
+
+    for table in Meta.tables.values():
+        columns = [c['name'] for c in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name in columns:
+                continue
+
+            logging.info("Adding column `%s' to the table `%s'", column.name,
+                         table.name)
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                           (table.name, column.name,
+                            column.type.compile(engine.dialect)))
+            if (table.name, column.name) in _BACKFILLS:
+                _BACKFILLS[(table.name, column.name)](engine)
+
+        indexes = {i['name']: bool(i['unique'])
+                   for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if indexes.get(index.name) == bool(index.unique):
+                continue
+
+            if index.name in indexes:
+                logging.info("Recreating index `%s'", index.name)
+                index.drop(engine)
+            else:
+                logging.info("Creating index `%s'", index.name)
+
+            if index.name in _BEFORE_INDEX:
+                _BEFORE_INDEX[index.name](engine)
+            index.create(engine)
+
+
+def _backfill_ts_us(engine):
+    """Calculate numeric timestamps for the existing messages"""
+    messages = Meta.tables['messages']
+    update = messages.update().\
+        where(messages.c.id == sqlalchemy.bindparam('_id')).\
+        values(ts_us=sqlalchemy.bindparam('_ts_us'))
+
+    last_id = 0
+    while True:
+        rows = engine.execute(sqlalchemy.select([messages.c.id,
+                                                 messages.c.ts]).
+                              where(messages.c.id > last_id).
+                              order_by(messages.c.id).
+                              limit(BATCH)).fetchall()
+        if not rows:
+            break
+
+        engine.execute(update, [{'_id': row.id,
+                                 '_ts_us': utils.ts_to_us(row.ts or 0)}
+                                for row in rows])
+        last_id = rows[-1].id
+
+
+def _remove_duplicate_messages(engine):
+    """
+    Remove messages (and related objects) which have the same timestamp in
+    the channel, leaving only first of them.
+    """
+    duplicates = ('SELECT id FROM messages WHERE channel_id IS NOT NULL AND '
+                  'id NOT IN (SELECT MIN(id) FROM messages '
+                  'GROUP BY channel_id, ts)')
+
+    with engine.begin() as conn:
+        for table in ('reactions', 'files', 'attachments'):
+            conn.execute('DELETE FROM %s WHERE message_id IN (%s)' %
+                         (table, duplicates))
+        result = conn.execute('DELETE FROM messages WHERE id IN (%s)' %
+                              duplicates)
+        if result.rowcount:
+            logging.warning('Removed %d duplicated messages',
+                            result.rowcount)
+
+
+_BACKFILLS = {('messages', 'ts_us'): _backfill_ts_us}
+_BEFORE_INDEX = {'ix_messages_channel_id_ts': _remove_duplicate_messages}
@@ -2,49 +2,175 @@
 Module for download files, store them in local filesystem and convert the URLs
 to local ones, so that sophisticated writers can make a use of it
 """
+import collections
+from concurrent import futures
 import functools
+import hashlib
 import logging
 import os
+import random
 import shutil
+import threading
+import time
+from urllib import parse
 
 import requests
+from requests import adapters
 
 from slack_backup import utils
 
 
+# Delay before the first retry of the failed request, which is doubled with
+# every next attempt, up to the BACKOFF_MAX seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Status codes, for which request is repeated
+RETRY_STATUSES = (401, 403, 408, 429, 500, 502, 503, 504)
+# Used in case of missing Retry-After header on rate limited response
+RETRY_AFTER = 30
+
+
+def _get_status(exc):
+    """Return HTTP status code for the exception, or None"""
+    if exc.response is None:
+        return None
+    return exc.response.status_code
+
+
+def _get_delay(exc, attempt):
+    """
+    Return number of seconds to wait before the next attempt. It's either
+    taken from Retry-After header, or calculated as exponential backoff with
+    full jitter.
+    """
+    if _get_status(exc) == 429:
+        try:
+            return int(exc.response.headers.get('Retry-After', RETRY_AFTER))
+        except ValueError:
+            return RETRY_AFTER
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
 def retry(count):
     """
     Decorator for a case, when there is some network hiccup, or slack servers
     are too busy to respond or on connection timeout. Parameter count says how
     many times it should try to perform request.
+
+    Requests are repeated after exponentially growing, randomized delay, or
+    after time requested by the server with Retry-After header. Session is
+    renewed only if the server rejects the credentials, and errors like 404
+    are not repeated at all.
     """
     def wrapper(func):
         @functools.wraps(func)
         def inner(obj, *args, **kwargs):
-            counter = count
+            attempt = 0
 
-            while counter:
-                counter -= 1
+            while True:
+                obj.breaker.wait()
+                session = obj.session
                 try:
-                    return func(obj, *args, **kwargs)
+                    result = func(obj, *args, **kwargs)
                 except requests.exceptions.RequestException as exc:
-                    if not counter:
+                    obj.breaker.failure()
+                    attempt += 1
+                    status = _get_status(exc)
+                    if (attempt >= count or
+                            (status and status not in RETRY_STATUSES)):
                         logging.error('Request for %s failed. Reported '
-                                      'reason: %s', args[0], exc.__doc__)
+                                      'reason: %s', args[0], exc)
                         raise
+
+                    delay = _get_delay(exc, attempt - 1)
                     logging.warning('Request for %s failed. Reported '
-                                    'reason: %s. Retrying.', args[0],
-                                    exc.__doc__)
-                    # Renew the session before retry
-                    obj.authorize()
+                                    'reason: %s. Retrying in %.1f seconds.',
+                                    args[0], exc, delay)
+                    if status == 429:
+                        # the whole pool would be throttled anyway
+                        obj.breaker.pause(delay)
+                    else:
+                        time.sleep(delay)
+
+                    if status in (401, 403):
+                        obj.reauthorize(session)
+                else:
+                    obj.breaker.success()
+                    return result
         return inner
     return wrapper
 
 
+class CircuitBreaker(object):
+    """
+    Pause all the downloads for a while, after too many consecutive
+    failures, so that the threads are not hammering the server, which is
+    down or overloaded.
+    """
+
+    def __init__(self, threshold=5, pause=30, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.threshold = threshold
+        self.pause_time = pause
+        self._clock = clock
+        self._sleep = sleep
+        self._failures = 0
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block while the circuit is open"""
+        while True:
+            with self._lock:
+                delay = self._paused_until - self._clock()
+            if delay <= 0:
+                return
+            self._sleep(delay)
+
+    def pause(self, seconds):
+        """Stop all the requests for provided amount of seconds"""
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     self._clock() + seconds)
+
+    def failure(self):
+        """Register failed request, open the circuit if there are too many"""
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold:
+                return
+            self._failures = 0
+        logging.warning('Too many failed downloads, pausing for %d seconds',
+                        self.pause_time)
+        self.pause(self.pause_time)
+
+    def success(self):
+        """Register successful request"""
+        with self._lock:
+            self._failures = 0
+
+
 class NotAuthorizedError(requests.HTTPError):
     pass
 
 
+# Outcome of the download. path is the one returned by Download.download,
+# final is the path under which file content can be found, which might be
+# different, if the same content was downloaded before. sha256 and size are
+# set only if the file was actually downloaded, etag and modified are
+# validators returned by the server for the avatars.
+Result = collections.namedtuple('Result', ['path', 'final', 'status', 'url',
+                                           'sha256', 'size', 'etag',
+                                           'modified'])
+Result.__new__.__defaults__ = (None, None, None, None)
+# Default size of the blocks in which files are downloaded
+CHUNK_SIZE = 1048576
+# Connect and read timeouts for the downloads, in seconds
+TIMEOUT = (10, 60)
+# Number of hosts, for which connections are kept open
+POOL_HOSTS = 10
+
+
 class Download(object):
     """Download class for taking care of Slack internally uploaded files"""
 
@@ -56,41 +182,278 @@ class Download(object):
         self.assets_dir = assets_dir
         self._files = os.path.join(self.assets_dir, 'files')
         self._images = os.path.join(self.assets_dir, 'images')
+        # interrupted downloads, kept for resuming them on the next attempt
+        self._partial = os.path.join(self.assets_dir, '.partial')
         self._authorized = False
         self._hier_created = False
         self.cookies = {}
 
-    def download(self, url, filetype, ext=None):
+        # Number of downloads performed in the background. With 0, assets are
+        # downloaded synchronously.
+        self.jobs = 0
+        if 'download_jobs' in args and args.download_jobs:
+            self.jobs = args.download_jobs
+        self.chunk_size = CHUNK_SIZE
+        if 'download_chunk_size' in args and args.download_chunk_size:
+            self.chunk_size = args.download_chunk_size
+        # In deferred mode assets are not downloaded, only queued for the
+        # download command
+        self.defer = 'defer_downloads' in args and bool(args.defer_downloads)
+        self.timeout = TIMEOUT
+        # Adapter is shared between sessions, so that the open connections
+        # are kept, even if session is renewed.
+        self._adapter = adapters.HTTPAdapter(pool_connections=POOL_HOSTS,
+                                             pool_maxsize=max(self.jobs, 1))
+        self._executor = None
+        self._lock = threading.Lock()
+        self._auth_lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+        # paths for the files, which are being downloaded
+        self._reserved = set()
+        # partial files currently in use
+        self._partials = set()
+        # Result objects for finished downloads
+        self._results = collections.deque()
+        # content addressed index of the downloaded files; sha256 and url
+        # mapped to the path, where the content is stored
+        self._by_hash = {}
+        self._by_url = {}
+        # deferred downloads, both the new ones and the url to path mapping
+        # for all of them
+        self._queued = collections.deque()
+        self._queued_urls = {}
+
+    def add_assets(self, assets):
+        """
+        Add already downloaded files to the index. Assets is an iterable of
+        url, sha256, size and path tuples.
+        """
+        with self._lock:
+            for url, sha256, size, path in assets:
+                self._by_url[url] = (path, sha256, size)
+                self._by_hash.setdefault(sha256, path)
+
+    def add_queued(self, queued):
+        """
+        Add downloads queued earlier, so that their paths will not be used by
+        the other files. Queued is an iterable of url and path tuples.
+        """
+        with self._lock:
+            for url, path in queued:
+                self._queued_urls[url] = path
+                self._reserved.add(path)
+
+    def download(self, url, filetype, ext=None, etag=None, modified=None,
+                 size=None):
         """
-        Download asset, return local path to it
+        Schedule download of the asset, return local path to it. Status of the
+        download along with the final path for the file, if it turns out to
+        be the same as the file already downloaded, can be taken with
+        get_results method. Files already downloaded from the same url are
+        not downloaded again.
+
+        Avatars are always downloaded to the same path, so if the etag or
+        modified validators from the previous download are passed, request
+        is made conditional, and the file is left untouched if it wasn't
+        modified.
+
+        In deferred mode, download is only queued, and the queue can be taken
+        with get_queued method; size of the file is used for ordering the
+        queue.
         """
 
         if not self._hier_created:
             self._create_assets_dir()
 
         filepath = self.get_filepath(url, filetype, ext)
-        temp_file = utils.get_temp_name()
+        if not filepath:
+            return filepath
+
+        original = None
+        if filetype != 'avatar':
+            with self._lock:
+                if url in self._by_url:
+                    path, sha256, size = self._by_url[url]
+                    logging.debug("File `%s' was already downloaded to `%s'",
+                                  url, path)
+                    self._results.append(Result(path, path, 'done', url,
+                                                sha256, size))
+                    return path
+
+                if self.defer and url in self._queued_urls:
+                    return self._queued_urls[url]
+
+                if os.path.exists(filepath) or filepath in self._reserved:
+                    original = filepath
+                    filepath = self.calculate_new_filename(filepath,
+                                                           filetype)
+                self._reserved.add(filepath)
+
+        if self.defer:
+            with self._lock:
+                self._queued_urls[url] = filepath
+            self._queued.append({'url': url,
+                                 'filetype': filetype,
+                                 'path': filepath,
+                                 'host': parse.urlsplit(url).netloc,
+                                 'size': size,
+                                 'etag': etag,
+                                 'modified': modified})
+            return filepath
+
+        self.fetch(url, filetype, filepath, etag, modified, original)
+        return filepath
 
-        self._download(url, temp_file)
+    def fetch(self, url, filetype, filepath, etag=None, modified=None,
+              original=None):
+        """
+        Schedule download of the asset to the provided path, which was
+        returned by the download method before.
+        """
+        if not self._hier_created:
+            self._create_assets_dir()
 
-        if filepath and os.path.exists(filepath) and filetype != 'avatar':
-            if not utils.same_files(filepath, temp_file):
-                logging.warning("File `%s' already exist, renamed to `%s'",
-                                filepath,
-                                self.calculate_new_filename(filepath,
-                                                            filetype))
-                filepath = self.calculate_new_filename(filepath, filetype)
-                shutil.move(temp_file, filepath)
+        if filetype != 'avatar':
+            with self._lock:
+                known = self._by_url.get(url)
+            if known:
+                path, sha256, size = known
+                logging.debug("File `%s' was already downloaded to `%s'",
+                              url, path)
+                self._results.append(Result(filepath, path, 'done', url,
+                                            sha256, size))
+                return
+
+        if self.jobs:
+            if not self._executor:
+                self._executor = futures.ThreadPoolExecutor(self.jobs)
+            self._executor.submit(self._fetch, url, filepath, filetype,
+                                  original, etag, modified)
+        else:
+            self._fetch(url, filepath, filetype, original, etag, modified)
+
+    def get_queued(self):
+        """
+        Return list of dicts describing the downloads deferred since last
+        call.
+        """
+        queued = []
+        while self._queued:
+            queued.append(self._queued.popleft())
+        return queued
+
+    def get_results(self):
+        """
+        Return list of Result objects for the downloads finished since last
+        call.
+        """
+        results = []
+        while self._results:
+            results.append(self._results.popleft())
+        return results
+
+    def wait(self):
+        """Wait for all of the scheduled downloads to finish"""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _fetch(self, url, filepath, filetype, original=None, etag=None,
+               modified=None):
+        """
+        Download the file to the provided path. If the same content was
+        already downloaded, or it is the same as in the file under original
+        path, file is not stored again, and path to existing file is
+        reported as the final path.
+        """
+        temp_file = self._get_partial(url) if filetype != 'avatar' else None
+        if not temp_file:
+            temp_file = utils.get_temp_name()
+        headers = {}
+        if etag and os.path.exists(filepath):
+            headers['If-None-Match'] = etag
+        if modified and os.path.exists(filepath):
+            headers['If-Modified-Since'] = modified
+
+        try:
+            res, sha256, size = self._download(url, temp_file, headers)
+        except requests.exceptions.RequestException:
+            if temp_file in self._partials:
+                logging.info("Keeping partially downloaded `%s' for the "
+                             "next attempt", url)
             else:
-                logging.debug("File `%s' already exist, skipping", filepath)
-                os.unlink(filepath)
+                os.unlink(temp_file)
+            self._results.append(Result(filepath, filepath, 'failed', url))
+            return
+        finally:
+            with self._lock:
+                self._partials.discard(temp_file)
+
+        if filetype == 'avatar':
+            self._store_avatar(url, filepath, temp_file, res)
+            return
+
+        with self._lock:
+            final = self._by_hash.get(sha256)
+            if (not final and original and
+                    os.path.getsize(original) == size and
+                    utils.cached_digest(original) == sha256):
+                final = original
+
+            if final:
+                logging.debug("Content of `%s' already exist in `%s', "
+                              "skipping", url, final)
+                os.unlink(temp_file)
+            else:
+                if original:
+                    logging.warning("File `%s' already exist, renamed to "
+                                    "`%s'", original, filepath)
+                shutil.move(temp_file, filepath)
+                final = filepath
+                utils.store_digest(filepath, sha256)
+
+            self._by_hash.setdefault(sha256, final)
+            self._by_url[url] = (final, sha256, size)
+
+        self._results.append(Result(filepath, final, 'done', url, sha256,
+                                    size))
+
+    def _store_avatar(self, url, filepath, temp_file, res):
+        """Move downloaded avatar into place, unless it wasn't modified"""
+        status = 'done'
+        etag = modified = None
+        if res is not None:
+            etag = res.headers.get('ETag')
+            modified = res.headers.get('Last-Modified')
+
+        if res is not None and res.status_code == 304:
+            logging.debug("Avatar `%s' not modified, skipping", filepath)
+            status = 'unchanged'
+            os.unlink(temp_file)
         else:
             shutil.move(temp_file, filepath)
 
-        return filepath
+        self._results.append(Result(filepath, filepath, status, url,
+                                    etag=etag, modified=modified))
+
+    def _get_partial(self, url):
+        """
+        Return path to the partial file for the url, which is unique for the
+        url, so that download can be resumed in the next run. Return None if
+        it is already used by another download.
+        """
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        path = os.path.join(self._partial, name)
+        with self._lock:
+            if path in self._partials:
+                return None
+            self._partials.add(path)
+        # make sure it exists, as the temporary files do
+        open(path, 'ab').close()
+        return path
 
     def _create_assets_dir(self):
-        for path in (self._files, self._images):
+        for path in (self._files, self._images, self._partial):
             utils.makedirs(path)
 
         self._hier_created = True
@@ -101,7 +464,7 @@ class Download(object):
         typemap = {'avatar': self._images,
                    'file': self._files}
 
-        if filetype == 'file' and not self._authorized:
+        if filetype == 'file' and not (self._authorized or self.defer):
             logging.warning("There was no (valid) credentials passed, "
                             "therefore file `%s' cannot be downloaded", url)
             return
@@ -131,7 +494,8 @@ class Download(object):
     def calculate_new_filename(self, path, filetype):
         count = 1
 
-        while filetype != 'avatar' and os.path.exists(path):
+        while filetype != 'avatar' and (os.path.exists(path) or
+                                        path in self._reserved):
             if count == 1:
                 base, ext = os.path.splitext(path)
             path = base + ".%0.3d" % count + ext
@@ -140,23 +504,89 @@ class Download(object):
         return path
 
     @retry(3)
-    def _download(self, url, local):
-        """Download file"""
-
-        res = self.session.get(url, stream=True)
-
-        with open(local, 'wb') as fobj:
-            for chunk in res.iter_content(chunk_size=5120):
+    def _download(self, url, local, headers=None):
+        """
+        Download file, return the response along with sha256 hex digest and
+        size of the content, calculated on the fly. If local file is not
+        empty, download is continued from its end, if server supports range
+        requests, otherwise it is started over.
+        """
+        headers = dict(headers or {})
+        offset = os.path.getsize(local) if os.path.exists(local) else 0
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+
+        res = self.session.get(url, stream=True, headers=headers,
+                               timeout=self.timeout)
+        digest = hashlib.sha256()
+        size = 0
+        mode = 'wb'
+
+        if offset and res.status_code == 416:
+            logging.debug("Cannot resume `%s', starting over", url)
+            res.close()
+            os.unlink(local)
+            del headers['Range']
+            return self._download(url, local, headers)
+
+        res.raise_for_status()
+
+        if (offset and res.status_code == 206 and
+                res.headers.get('Content-Range', '').
+                startswith('bytes %d-' % offset)):
+            logging.debug("Resuming download of `%s' from %d bytes", url,
+                          offset)
+            mode = 'ab'
+            with open(local, 'rb') as fobj:
+                for chunk in iter(lambda: fobj.read(utils.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            size = offset
+
+        with open(local, mode) as fobj:
+            for chunk in res.iter_content(chunk_size=self.chunk_size):
                 if chunk:
                     fobj.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
         logging.debug("Downloaded `%s' to `'%s'", url, local)
+        return res, digest.hexdigest(), size
+
+    def get_stats(self):
+        """
+        Return number of requests and number of connections made by the
+        sessions, for the hosts which connection pools are still kept.
+        """
+        requests_num = connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_num += pool.num_requests
+            connections += pool.num_connections
+        return requests_num, connections
+
+    def _new_session(self):
+        """Return new session using the shared connection pools"""
+        session = requests.Session()
+        session.mount('https://', self._adapter)
+        session.mount('http://', self._adapter)
+        return session
+
+    def reauthorize(self, session):
+        """
+        Renew the session, unless it was already done by another thread since
+        the session was used.
+        """
+        with self._auth_lock:
+            if self.session is session:
+                self.authorize()
 
     def authorize(self):
         """
         Authenticate and gather session for Slack
         """
-        self.session = requests.session()  # new session
-        res = self.session.get('https://%s.slack.com/' % self.team)
+        self.session = self._new_session()
+        res = self.session.get('https://%s.slack.com/' % self.team,
+                               timeout=self.timeout)
 
         if not all((self.team, self.password, self.user)):
             logging.warning('There is neither username, password or team name'
@@ -176,7 +606,8 @@ class Download(object):
                                 {'crumb': crumb,
                                  'email': self.user,
                                  'password': self.password,
-                                 'signin': 1})
+                                 'signin': 1},
+                                timeout=self.timeout)
         self.cookies = requests.utils.dict_from_cookiejar(self.session.cookies)
         if not ('d' in self.cookies and 'd-s' in self.cookies):
             logging.error('Failed to login into Slack app')
@@ -2,7 +2,7 @@
 Convinient object mapping from slack API reponses
 """
 from sqlalchemy import Column, Integer, Text, Boolean, ForeignKey
-from sqlalchemy import DateTime
+from sqlalchemy import BigInteger, DateTime, Index
 from sqlalchemy.orm import relationship
 
 from slack_backup.db import Base
@@ -81,6 +81,8 @@ class Channel(Base):
     purpose = relationship("Purpose", uselist=False, back_populates="channel")
     topic = relationship("Topic", uselist=False, back_populates="channel")
     messages = relationship("Message", back_populates="channel")
+    checkpoint = relationship("Checkpoint", uselist=False,
+                              back_populates="channel")
 
     def __init__(self, data_dict=None):
         self.update(data_dict)
@@ -100,6 +102,32 @@ class Channel(Base):
         return u'%s, %s %s' % (self.__class__.__name__, self.id, self.name)
 
 
+class Checkpoint(Base):
+    """
+    Progress of fetching the channel history. Updated in the same transaction
+    as the page of messages is stored.
+    """
+    __tablename__ = 'checkpoints'
+
+    id = Column(Integer, primary_key=True)
+    # timestamp which should be passed as the oldest parameter for the next
+    # portion of the messages
+    cursor = Column(Text)
+    # number of the last committed page of the current fetch
+    page = Column(Integer, default=0)
+    complete = Column(Boolean, default=False)
+    updated = Column(DateTime)
+
+    channel_id = Column(Integer, ForeignKey('channels.id'), index=True)
+    channel = relationship("Channel", back_populates="checkpoint")
+
+    def __repr__(self):
+        return u'<%s %s>' % (str(hex(id(self))), self.__unicode__())
+
+    def __unicode__(self):
+        return u'%s, %s %s' % (self.__class__.__name__, self.id, self.cursor)
+
+
 class UserProfile(Base):
     __tablename__ = "profiles"
 
@@ -118,6 +146,9 @@ class UserProfile(Base):
     real_name = Column(Text)
     real_name_normalized = Column(Text)
     image_path = Column(Text)
+    # validators of the downloaded avatar, for the conditional requests
+    avatar_etag = Column(Text)
+    avatar_modified = Column(Text)
 
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
     user = relationship("User", back_populates="profile")
@@ -204,6 +235,11 @@ class Reaction(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    # There can be only one message with certain ts in the channel
+    __table_args__ = (Index('ix_messages_channel_id_ts', 'channel_id',
+                            'ts', unique=True),
+                      Index('ix_messages_channel_id_ts_us', 'channel_id',
+                            'ts_us'))
 
     id = Column(Integer, primary_key=True)
     # NOTE(gryf): timestamps from messages are coming as text. It might be
@@ -215,6 +251,9 @@ class Message(Base):
     # oldest, that's why it could be easy to lost some messages if the
     # difference would be on microseconds level.
     ts = Column(Text, index=True)
+    # Exact, numeric representation of the ts above in microseconds, used for
+    # sorting and range queries.
+    ts_us = Column(BigInteger)
     text = Column(Text)
     type = Column(Text)
     is_starred = Column(Boolean, default=False)
@@ -235,12 +274,13 @@ class Message(Base):
         self.update(data_dict)
 
     def datetime(self):
-        return utils.fromtimestamp(float(self.ts))
+        return utils.fromtimestamp(self.ts_us / 1000000)
 
     def update(self, data_dict):
         data_dict = data_dict or {}
 
         self.ts = data_dict.get('ts', 0)
+        self.ts_us = utils.ts_to_us(self.ts)
         self.text = data_dict.get('text', '')
         self.type = data_dict.get('subtype', '')
 
@@ -252,7 +292,12 @@ class File(Base):
     url = Column(Text)
     name = Column(Text)
     title = Column(Text)
-    filepath = Column(Text)
+    filepath = Column(Text, index=True)
+    # status of the download: pending, done or failed
+    status = Column(Text)
+    # hash and size of the downloaded content
+    sha256 = Column(Text)
+    size = Column(Integer)
 
     message_id = Column(Integer, ForeignKey('messages.id'))
     message = relationship('Message', back_populates='files')
@@ -267,6 +312,52 @@ class File(Base):
         self.title = data_dict.get('title', '')
 
 
+class Asset(Base):
+    """
+    Index of the downloaded files content. Every url is downloaded only once,
+    and files with the same content (with the same sha256 hash) share the
+    path.
+    """
+    __tablename__ = "assets"
+
+    id = Column(Integer, primary_key=True)
+    url = Column(Text, unique=True)
+    sha256 = Column(Text, index=True)
+    size = Column(Integer)
+    path = Column(Text)
+
+    def __repr__(self):
+        return u'<%s %s>' % (str(hex(id(self))), self.__unicode__())
+
+    def __unicode__(self):
+        return u'%s, %s %s' % (self.__class__.__name__, self.sha256, self.path)
+
+
+class QueuedDownload(Base):
+    """
+    Files and avatars, which download was deferred to the download command.
+    Path is the one, under which the file is registered in the files or
+    profiles table.
+    """
+    __tablename__ = "download_queue"
+    __table_args__ = (Index('ix_download_queue_host_size', 'host', 'size'),)
+
+    id = Column(Integer, primary_key=True)
+    url = Column(Text)
+    filetype = Column(Text)
+    path = Column(Text, unique=True)
+    host = Column(Text)
+    size = Column(Integer)
+    etag = Column(Text)
+    modified = Column(Text)
+
+    def __repr__(self):
+        return u'<%s %s>' % (str(hex(id(self))), self.__unicode__())
+
+    def __unicode__(self):
+        return u'%s, %s %s' % (self.__class__.__name__, self.url, self.path)
+
+
 class Attachment(Base):
     __tablename__ = "attachments"
 
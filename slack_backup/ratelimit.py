@@ -0,0 +1,111 @@
+"""
+Rate limiting of the Slack API calls.
+
+Slack assign every API method to one of the tiers, which have different
+limits of calls per minute. All the calls should go through the Scheduler, so
+that we will not exceed those limits, no matter how many threads are issuing
+the calls.
+"""
+import logging
+import threading
+import time
+
+
+# Calls per minute for each of the tiers, see
+# https://api.slack.com/docs/rate-limits
+TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHODS = {'bots.info': 3,
+           'channels.history': 3,
+           'channels.list': 2,
+           'users.list': 2}
+DEFAULT_TIER = 3
+# Used in case of missing Retry-After header on rate limited response
+RETRY_AFTER = 30
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, which is refilled with rate tokens per minute
+    up to its capacity.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate / 60.0
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until token is available and take it"""
+        while True:
+            with self._lock:
+                now = self._refill()
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+
+    def block(self, seconds):
+        """Don't hand out any tokens for provided amount of seconds"""
+        with self._lock:
+            now = self._refill()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self.tokens = 0
+
+    def _refill(self):
+        """Add tokens for the time passed since last refill, return now"""
+        now = self._clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        return now
+
+
+class Scheduler(object):
+    """
+    Pass the API calls through the token buckets, one for each tier. Calls
+    which were rate limited by Slack anyway, are repeated after the time
+    reported by the Retry-After header, and the whole tier is paused for that
+    time.
+    """
+
+    def __init__(self, slack, clock=time.monotonic, sleep=time.sleep):
+        self.slack = slack
+        self._buckets = {tier: TokenBucket(rate, clock=clock, sleep=sleep)
+                         for tier, rate in TIERS.items()}
+
+    def api_call(self, method, **kwargs):
+        """
+        Perform API call on the slack client, return its result. It will
+        block until call will be allowed by the rate limits.
+        """
+        bucket = self._buckets[METHODS.get(method, DEFAULT_TIER)]
+
+        while True:
+            bucket.acquire()
+            result = self.slack.api_call(method, **kwargs)
+            if result.get('error') != 'ratelimited':
+                return result
+
+            delay = self._get_retry_after(result)
+            logging.warning("Rate limit exceeded for `%s', retrying in %s "
+                            "seconds", method, delay)
+            bucket.block(delay)
+
+    def _get_retry_after(self, result):
+        """Return number of seconds to wait, taken out of response headers"""
+        for key, value in result.get('headers', {}).items():
+            if key.lower() == 'retry-after':
+                try:
+                    return int(value)
+                except ValueError:
+                    break
+        return RETRY_AFTER
@@ -65,7 +65,7 @@ class Reporter(object):
                     raise
             for message in self.q(o.Message).\
                     filter(o.Message.channel == channel).\
-                    order_by(o.Message.ts).all():
+                    order_by(o.Message.ts_us).all():
                 messages.append(message)
             self.write_msg(messages, log_path, channel)
 
@@ -199,7 +199,7 @@ class TextReporter(Reporter):
                     raise
             for message in self.q(o.Message).\
                     filter(o.Message.channel == channel).\
-                    order_by(o.Message.ts).all():
+                    order_by(o.Message.ts_us).all():
                 messages.append(message)
 
             self.write_msg(messages, log_path, channel)
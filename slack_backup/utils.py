@@ -3,6 +3,7 @@ Some utils functions. Jsut to not copypaste the code around
 """
 from datetime import datetime
 import errno
+import json
 import os
 import logging
 import tempfile
@@ -33,18 +34,109 @@ def get_temp_name(suffix='', prefix='tmp', dir=None, unlink=False):
     return fname
 
 
+# Size of the blocks in which files are read for hashing and comparing
+CHUNK_SIZE = 65536
+
+
+def file_digest(path):
+    """Return hex digest of sha256 hash for the file content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _digest_sidecar(path):
+    """Return path to the hidden file with cached digest for the path"""
+    dirname, fname = os.path.split(path)
+    return os.path.join(dirname, '.%s.sha256' % fname)
+
+
+def store_digest(path, digest):
+    """
+    Save digest of the file in the sidecar file along with the file size and
+    modification time, so that it can be reused by cached_digest.
+    """
+    stat = os.stat(path)
+    try:
+        with open(_digest_sidecar(path), 'w') as fobj:
+            fobj.write('%s %d %d\n' % (digest, stat.st_size,
+                                       stat.st_mtime_ns))
+    except OSError:
+        logging.warning("Cannot store digest for `%s'", path)
+
+
+def cached_digest(path):
+    """
+    Return hex digest of sha256 hash for the file content. Digest is taken
+    from the sidecar file, if the file size and modification time didn't
+    change since it was stored, otherwise it is calculated and stored.
+    """
+    stat = os.stat(path)
+    try:
+        with open(_digest_sidecar(path)) as fobj:
+            digest, size, mtime = fobj.read().split()
+        if int(size) == stat.st_size and int(mtime) == stat.st_mtime_ns:
+            return digest
+    except (OSError, ValueError):
+        pass
+
+    digest = file_digest(path)
+    store_digest(path, digest)
+    return digest
+
+
 def same_files(file1, file2):
     """
-    Compare files by calculating hash for each of them. Return True if hash is
-    identical, False otherwise
+    Compare files content. Return True if it is identical, False otherwise
     """
-    with open(file1, 'rb') as fobj:
-        hash1 = hashlib.sha256(fobj.read())
+    if os.path.getsize(file1) != os.path.getsize(file2):
+        return False
+
+    with open(file1, 'rb') as fobj1, open(file2, 'rb') as fobj2:
+        while True:
+            chunk = fobj1.read(CHUNK_SIZE)
+            if chunk != fobj2.read(CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
 
-    with open(file2, 'rb') as fobj:
-        hash2 = hashlib.sha256(fobj.read())
 
-    return hash1.hexdigest() == hash2.hexdigest()
+class JSONListWriter(object):
+    """
+    Write JSON list to the file, item by item, so that the whole list doesn't
+    need to be kept in memory.
+    """
+
+    def __init__(self, path):
+        self._fobj = open(path, 'w')
+        self._fobj.write('[')
+        self._empty = True
+
+    def extend(self, items):
+        """Write items to the file"""
+        for item in items:
+            if not self._empty:
+                self._fobj.write(', ')
+            self._fobj.write(json.dumps(item))
+            self._empty = False
+
+    def close(self):
+        """Close the list and the file"""
+        if not self._fobj.closed:
+            self._fobj.write(']')
+            self._fobj.close()
+
+
+def ts_to_us(timestamp):
+    """
+    Return number of microseconds for the Slack timestamp, which is a string
+    like "1479501074.000032". Conversion is exact, contrary to going through
+    float.
+    """
+    seconds, _, fraction = str(timestamp).partition('.')
+    return int(seconds) * 1000000 + int((fraction + '000000')[:6])
 
 
 def fromtimestamp(timestamp):
@@ -1,10 +1,18 @@
 import copy
+import json
+import os
+import tempfile
 import unittest
 from unittest import mock
 
 from slack_backup import client
 from slack_backup import objects as o
 
+# result of the mocked download of empty file
+EMPTY_SHA = ('e3b0c44298fc1c149afbf4c8996fb924'
+             '27ae41e4649b934ca495991b7852b855')
+DOWNLOADED = (None, EMPTY_SHA, 0)
+
 CHANNELS = {"ok": True,
             "channels": [{"id": "C00000000",
                           "name": "somechannel",
@@ -610,7 +618,7 @@ class TestApiCalls(unittest.TestCase):
         cl = client.Client(FakeArgs())
 
         cl.slack.api_call = mock.MagicMock(return_value=USERS)
-        cl.downloader._download = mock.MagicMock(return_value=None)
+        cl.downloader._download = mock.MagicMock(return_value=DOWNLOADED)
         cl.update_users()
 
         cl.slack.api_call = mock.MagicMock(return_value=CHANNELS)
@@ -622,15 +630,15 @@ class TestApiCalls(unittest.TestCase):
         channel = cl.q(o.Channel).filter(o.Channel.slackid ==
                                          "C00000001").one()
 
-        msg, ts = cl._channels_history(channel, 0)
+        msg, ts = cl._channels_history(channel.slackid, 0)
         self.assertEqual(len(msg), 6)
         self.assertEqual(ts, '1479501074.000032')
 
-        msg, ts = cl._channels_history(channel, ts)
+        msg, ts = cl._channels_history(channel.slackid, ts)
         self.assertEqual(len(msg), 1)
         self.assertEqual(ts, '1479505026.000002')
 
-        msg, ts = cl._channels_history(channel, ts)
+        msg, ts = cl._channels_history(channel.slackid, ts)
         self.assertEqual(len(msg), 0)
         self.assertIsNone(ts)
 
@@ -640,7 +648,7 @@ class TestClient(unittest.TestCase):
     def test_update_users(self):
         cl = client.Client(FakeArgs())
         cl.slack.api_call = mock.MagicMock(return_value=USERS)
-        cl.downloader._download = mock.MagicMock(return_value=None)
+        cl.downloader._download = mock.MagicMock(return_value=DOWNLOADED)
         cl.update_users()
         users = cl.session.query(o.User).all()
         self.assertEqual(len(users), 4)
@@ -652,6 +660,41 @@ class TestClient(unittest.TestCase):
         self.assertEqual(users[0].id, 1)
         self.assertEqual(users[0].slackid, 'UAAAAAAAA')
 
+    def test_avatar_sync(self):
+        cl = client.Client(FakeArgs())
+        response = mock.MagicMock(status_code=200,
+                                  headers={'ETag': '"etag"'})
+        cl.downloader._download = mock.MagicMock(return_value=(response,
+                                                               EMPTY_SHA, 0))
+
+        with tempfile.TemporaryDirectory() as dirname:
+            cl.downloader._images = dirname
+            cl.slack.api_call = mock.MagicMock(return_value=USERS)
+            cl.update_users()
+            cl._record_downloads()
+            self.assertEqual(cl.downloader._download.call_count, 3)
+            self.assertEqual({p.avatar_etag for p in
+                              cl.q(o.UserProfile).all()
+                              if p.image_original}, {'"etag"'})
+
+            # nothing changed
+            cl.downloader._download.reset_mock()
+            cl.update_users()
+            cl.downloader._download.assert_not_called()
+
+            # avatar hash changed, server responds it's the same image
+            users = copy.deepcopy(USERS)
+            users['members'][1]['profile']['avatar_hash'] = 'changed'
+            cl.slack.api_call = mock.MagicMock(return_value=users)
+            response.status_code = 304
+            cl.update_users()
+
+            self.assertEqual(cl.downloader._download.call_count, 1)
+            headers = cl.downloader._download.call_args[0][2]
+            self.assertDictEqual(headers, {'If-None-Match': '"etag"'})
+            self.assertEqual([r.status for r in
+                              cl.downloader.get_results()], ['unchanged'])
+
 
 class TestMessage(unittest.TestCase):
 
@@ -662,7 +705,7 @@ class TestMessage(unittest.TestCase):
         self.cl = client.Client(args)
         self.cl.downloader.authorize = mock.MagicMock()
         self.cl.slack.api_call = mock.MagicMock(return_value=USERS)
-        self.cl.downloader._download = mock.MagicMock(return_value=None)
+        self.cl.downloader._download = mock.MagicMock(return_value=DOWNLOADED)
         self.cl.update_users()
 
         self.cl.slack.api_call = mock.MagicMock(return_value=CHANNELS)
@@ -675,15 +718,210 @@ class TestMessage(unittest.TestCase):
 
         download.return_value = 'foo'
 
-        self.cl.downloader._download = mock.MagicMock(return_value=None)
+        self.cl.downloader._download = mock.MagicMock(return_value=DOWNLOADED)
+        self.cl.slack.api_call.side_effect = [MSGS, MSG3]
+        self.cl.update_history()
+        self.assertEqual(len(self.cl.q(o.Message).all()), 5)
+
+        msg = self.cl.q(o.Message).filter(o.Message.ts ==
+                                          '1479493038.000029').one()
+        self.assertEqual(msg.channel.name, 'general')
+        self.assertEqual(msg.user.slackid, 'UCCCCCCCC')
+        self.assertEqual([r.name for r in msg.reactions], ['+1'])
+        self.assertEqual([a.title for a in msg.attachments],
+                         ['Nulla sollicitudin'])
+        self.assertFalse(msg.is_starred)
+        self.assertEqual(len(self.cl.q(o.File).all()), 2)
+
+        self.cl.slack.api_call.side_effect = [MSG2, MSG3]
+        self.cl.update_history()
+
+        self.assertEqual(len(self.cl.q(o.Message).all()), 6)
+
+    def test_update_history_downloads(self):
+
+        with tempfile.TemporaryDirectory() as dirname:
+            self.cl.downloader._authorized = True
+            self.cl.downloader._files = os.path.join(dirname, 'files')
+            self.cl.downloader._images = os.path.join(dirname, 'images')
+            self.cl.downloader.jobs = 2
+
+            self.cl.slack.api_call.side_effect = [MSGS, MSG3]
+            self.cl.update_history()
+            self.cl.downloader.wait()
+            self.cl._record_downloads()
+
+            files = self.cl.q(o.File).all()
+            self.assertEqual(len(files), 2)
+            for file_ in files:
+                self.assertEqual(file_.status, 'done')
+                self.assertEqual(file_.sha256, EMPTY_SHA)
+                self.assertEqual(file_.size, 0)
+                self.assertTrue(os.path.exists(file_.filepath))
+
+            # both files are empty, so content is stored only once
+            self.assertEqual(len({f.filepath for f in files}), 1)
+            assets = self.cl.q(o.Asset).all()
+            self.assertEqual(len(assets), 2)
+            self.assertEqual(len({a.sha256 for a in assets}), 1)
+
+    def test_deferred_downloads(self):
+
+        with tempfile.TemporaryDirectory() as dirname:
+            self.cl.downloader.defer = True
+            self.cl.downloader._files = os.path.join(dirname, 'files')
+            self.cl.downloader._download.reset_mock()
+
+            self.cl.slack.api_call.side_effect = [MSGS, MSG3]
+            self.cl.update_history()
+
+            self.cl.downloader._download.assert_not_called()
+            queue = self.cl.q(o.QueuedDownload).all()
+            self.assertEqual(len(queue), 2)
+            self.assertEqual({q.host for q in queue}, {'files.slack.com'})
+            self.assertEqual({f.filepath for f in self.cl.q(o.File).all()},
+                             {q.path for q in queue})
+
+            self.cl.downloader.defer = False
+            self.cl.download_assets()
+
+            self.assertEqual(self.cl.downloader._download.call_count, 2)
+            self.assertEqual(self.cl.q(o.QueuedDownload).count(), 0)
+            for file_ in self.cl.q(o.File).all():
+                self.assertEqual(file_.status, 'done')
+                self.assertTrue(os.path.exists(file_.filepath))
+
+    @mock.patch('slack_backup.download.Download.download')
+    def test_update_history_twice(self, download):
+
+        download.return_value = 'foo'
+
         self.cl.slack.api_call.side_effect = [MSGS, MSG3]
         self.cl.update_history()
+
+        # pretend, that fetch was started from scratch
+        self.cl.session.delete(self.cl.q(o.Checkpoint).one())
+        self.cl.session.commit()
+
+        self.cl.slack.api_call.side_effect = [MSGS, MSG3]
+        self.cl.update_history()
+
+        self.assertEqual(len(self.cl.q(o.Message).all()), 5)
+        self.assertEqual(len(self.cl.q(o.Reaction).all()), 1)
+        self.assertEqual(len(self.cl.q(o.Attachment).all()), 1)
+        self.assertEqual(len(self.cl.q(o.File).all()), 2)
+
+    @mock.patch('slack_backup.download.Download.download')
+    def test_latest_timestamps(self, download):
+
+        download.return_value = 'foo'
+
+        self.assertDictEqual(self.cl._get_latest_timestamps(),
+                             {1: None, 2: None})
+
+        self.cl.slack.api_call.side_effect = [MSGS, MSG3]
+        self.cl.update_history()
+
+        self.assertDictEqual(self.cl._get_latest_timestamps(),
+                             {1: None, 2: '1479501074.000032'})
+
+    @mock.patch('slack_backup.download.Download.download')
+    def test_update_history_resume(self, download):
+
+        download.return_value = 'foo'
+
+        self.cl.slack.api_call.side_effect = [MSGS, IOError('network')]
+        self.assertRaises(IOError, self.cl.update_history)
         self.assertEqual(len(self.cl.q(o.Message).all()), 5)
 
+        checkpoint = self.cl.q(o.Checkpoint).one()
+        self.assertEqual(checkpoint.cursor, '1479501074.000032')
+        self.assertEqual(checkpoint.page, 1)
+        self.assertFalse(checkpoint.complete)
+
         self.cl.slack.api_call.side_effect = [MSG2, MSG3]
         self.cl.update_history()
 
+        self.assertEqual(self.cl.slack.api_call.call_args_list[2],
+                         mock.call('channels.history', channel='C00000001',
+                                   count=1000, oldest='1479501074.000032'))
         self.assertEqual(len(self.cl.q(o.Message).all()), 6)
+        self.assertEqual(checkpoint.cursor, '1479505026.000002')
+        self.assertEqual(checkpoint.page, 3)
+        self.assertTrue(checkpoint.complete)
+
+    @mock.patch('slack_backup.download.Download.download')
+    def test_update_history_raw(self, download):
+
+        download.return_value = 'foo'
+
+        with tempfile.TemporaryDirectory() as dirname:
+            self.cl._raw_fname = os.path.join(dirname, '{name}.json')
+            self.cl.slack.api_call.side_effect = [MSGS, MSG2, MSG3]
+            self.cl.update_history()
+
+            with open(os.path.join(dirname, 'channel-general.json')) as fobj:
+                raw = json.load(fobj)
+
+        self.assertListEqual(raw, MSGS['messages'] + MSG2['messages'])
+        self.assertEqual(len(self.cl.q(o.Message).all()), 6)
+
+    @mock.patch('slack_backup.download.Download.download')
+    def test_update_history_parallel(self, download):
+
+        download.return_value = 'foo'
+
+        def api_call(method, channel=None, **kwargs):
+            if channel == 'C00000001':
+                return responses.pop(0)
+            return MSG3
+
+        responses = [MSGS, MSG3]
+        self.cl.selected_channels = None
+        self.cl._jobs = 2
+        self.cl.slack.api_call.side_effect = api_call
+        self.cl.update_history()
+
+        messages = self.cl.q(o.Message).all()
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(set(m.channel.name for m in messages), {'general'})
+
+
+class TestGetUser(unittest.TestCase):
+
+    def setUp(self):
+        self.cl = client.Client(FakeArgs())
+        self.cl.slack.api_call = mock.MagicMock(return_value=USERS)
+        self.cl.downloader._download = mock.MagicMock(return_value=DOWNLOADED)
+        self.cl.update_users()
+        self.cl._users = {u.slackid: u for u in self.cl.q(o.User).all()}
+
+    def test_cached_user(self):
+        self.cl.q = mock.MagicMock()
+        user = self.cl._get_user({'user': 'UAAAAAAAA'})
+        self.assertEqual(user.slackid, 'UAAAAAAAA')
+
+        user = self.cl._get_user({'comment': {'user': 'UBBBBBBBB'}})
+        self.assertEqual(user.slackid, 'UBBBBBBBB')
+        self.cl.q.assert_not_called()
+
+    def test_bot(self):
+        self.cl.slack.api_call = mock.MagicMock(return_value={
+            'ok': True, 'bot': {'id': 'B00000001', 'name': 'botname'}})
+
+        user = self.cl._get_user({'bot_id': 'B00000001'})
+        self.assertEqual(user.real_name, 'botname')
+        self.assertIs(self.cl._get_user({'bot_id': 'B00000001'}), user)
+        self.cl.slack.api_call.assert_called_once_with('bots.info',
+                                                       bot='B00000001')
+
+    def test_missing_bot(self):
+        self.cl.slack.api_call = mock.MagicMock(return_value={
+            'ok': False, 'error': 'bot_not_found'})
+
+        self.assertIsNone(self.cl._get_user({'bot_id': 'B00000002'}))
+        self.assertIsNone(self.cl._get_user({'bot_id': 'B00000002'}))
+        self.assertEqual(self.cl.slack.api_call.call_count, 1)
 
 
 class TestCreateMessage(unittest.TestCase):
@@ -696,7 +934,8 @@ class TestCreateMessage(unittest.TestCase):
         cl.session = mock.MagicMock()
         channel = o.Channel({'name': 'test', 'id': 'C00000001'})
 
-        cl._create_message({'type': 'message', 'text': ''}, channel)
+        self.assertIsNone(cl._create_message({'type': 'message', 'text': ''},
+                                             channel))
         cl.session.add.assert_not_called()
 
     @mock.patch('slack_backup.client.Client._file_data')
@@ -707,9 +946,8 @@ class TestCreateMessage(unittest.TestCase):
         cl.session = mock.MagicMock()
         channel = o.Channel({'name': 'test', 'id': 'C00000001'})
 
-        cl._create_message(MSGS['messages'][1], channel)
+        msg = cl._create_message(MSGS['messages'][1], channel)
 
-        msg = cl.session.add.call_args[0][0]
         self.assertEqual(len(msg.attachments), 1)
         self.assertEqual(len(msg.reactions), 1)
         self.assertEqual(msg.reactions[0].name, '+1')
@@ -727,9 +965,8 @@ class TestCreateMessage(unittest.TestCase):
                 "text": "test",
                 "ts": "1479501074.000032",
                 "is_starred": True}
-        cl._create_message(data, channel)
+        msg = cl._create_message(data, channel)
 
-        msg = cl.session.add.call_args[0][0]
         self.assertEqual(len(msg.attachments), 0)
         self.assertEqual(msg.text, 'test')
         self.assertEqual(msg.type, '')
@@ -743,9 +980,8 @@ class TestCreateMessage(unittest.TestCase):
         cl.session = mock.MagicMock()
         channel = o.Channel({'name': 'test', 'id': 'C00000001'})
 
-        cl._create_message(SHARED, channel)
+        msg = cl._create_message(SHARED, channel)
 
-        msg = cl.session.add.call_args[0][0]
         self.assertEqual(len(msg.attachments), 0)
         self.assertTrue('shared a file' in msg.text)
         self.assertFalse(msg.is_starred)
@@ -761,9 +997,8 @@ class TestCreateMessage(unittest.TestCase):
         cl._url_file_to_attachment = True
         channel = o.Channel({'name': 'test', 'id': 'C00000001'})
 
-        cl._create_message(PINNED, channel)
+        msg = cl._create_message(PINNED, channel)
 
-        msg = cl.session.add.call_args[0][0]
         self.assertEqual(len(msg.attachments), 1)
         self.assertEqual(msg.text, '<@UAAAAAAAA> pinned a message to this '
                          'channel.')
@@ -828,7 +1063,7 @@ class TestFileShare(unittest.TestCase):
                          'assets/files/aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee\n')
 
         cl._file_data(msg, EXTERNAL_DATA['files'][0])
-        file_ = cl.session.add.call_args[0][0]
+        file_ = msg.files[0]
         self.assertEqual(cl._dldata, [expexted_line])
         self.assertEqual(file_.filepath,
                          'assets/files/aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee')
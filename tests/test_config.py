@@ -60,12 +60,17 @@ class TestConfig(unittest.TestCase):
                                           'quiet': 0,
                                           'channels': [],
                                           'database': None,
+                                          'db_profile': 'performance',
                                           'user': None,
                                           'password': None,
                                           'team': None,
                                           'token': None,
                                           'url_file_to_attachment': False,
-                                          'raw_dir': None})
+                                          'raw_dir': None,
+                                          'jobs': 1,
+                                          'download_jobs': 4,
+                                          'download_chunk_size': 1048576,
+                                          'defer_downloads': False})
 
         args = argparse.Namespace()
         args.config = self.confname
@@ -94,6 +99,7 @@ class TestConfig(unittest.TestCase):
                                           'quiet': 0,
                                           'channels': ['one', 'two', 'three'],
                                           'database': 'dbfname.sqlite',
+                                          'db_profile': 'performance',
                                           'user': 'someuser@address.com',
                                           'password': 'secret',
                                           'team': 'myteam',
@@ -101,7 +107,11 @@ class TestConfig(unittest.TestCase):
                                                    '222222222222-333333333333-'
                                                    'r4nd0ms7uff',
                                           'url_file_to_attachment': False,
-                                          'raw_dir': None})
+                                          'raw_dir': None,
+                                          'jobs': 1,
+                                          'download_jobs': 4,
+                                          'download_chunk_size': 1048576,
+                                          'defer_downloads': False})
 
         # override some conf options with commandline
         args = argparse.Namespace()
@@ -125,9 +135,14 @@ class TestConfig(unittest.TestCase):
                                           'quiet': 2,
                                           'channels': ['foo'],
                                           'database': 'dbfname.sqlite',
+                                          'db_profile': 'performance',
                                           'user': 'joe',
                                           'password': 'ultricies',
                                           'team': '',
                                           'token': 'the token',
                                           'url_file_to_attachment': False,
-                                          'raw_dir': None})
+                                          'raw_dir': None,
+                                          'jobs': 1,
+                                          'download_jobs': 4,
+                                          'download_chunk_size': 1048576,
+                                          'defer_downloads': False})
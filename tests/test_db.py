@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import sqlalchemy
+
+from slack_backup import db
+from slack_backup import objects as o
+
+
+OLD_SCHEMA = """\
+CREATE TABLE messages (id INTEGER NOT NULL, ts TEXT, text TEXT, type TEXT,
+                       is_starred BOOLEAN, user_id INTEGER,
+                       channel_id INTEGER, PRIMARY KEY (id));
+INSERT INTO messages (id, ts, text, channel_id)
+    VALUES (1, '1479501074.000032', 'foo', 1);
+INSERT INTO messages (id, ts, text, channel_id)
+    VALUES (2, '1479501074.1', 'bar', 1);
+INSERT INTO messages (id, ts, text, channel_id)
+    VALUES (3, '1479501074.1', 'bar', 1);
+CREATE TABLE reactions (id INTEGER NOT NULL, name TEXT, message_id INTEGER,
+                        PRIMARY KEY (id));
+INSERT INTO reactions (id, name, message_id) VALUES (1, '+1', 2);
+INSERT INTO reactions (id, name, message_id) VALUES (2, '+1', 3);
+"""
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbname = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        conn = sqlite3.connect(self.dbname)
+        conn.executescript(OLD_SCHEMA)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.dbname + suffix):
+                os.unlink(self.dbname + suffix)
+
+    def test_ts_us(self):
+        engine = db.connect(self.dbname)
+        session = db.Session()
+
+        messages = session.query(o.Message).order_by(o.Message.id).all()
+        self.assertEqual([m.ts_us for m in messages],
+                         [1479501074000032, 1479501074100000])
+
+        indexes = [i['name'] for i in
+                   sqlalchemy.inspect(engine).get_indexes('messages')]
+        self.assertIn('ix_messages_channel_id_ts_us', indexes)
+        session.close()
+
+    def test_duplicates(self):
+        engine = db.connect(self.dbname)
+        session = db.Session()
+
+        self.assertEqual([m.id for m in session.query(o.Message).all()],
+                         [1, 2])
+        self.assertEqual([r.message_id for r in
+                          session.query(o.Reaction).all()], [2])
+
+        indexes = {i['name']: i['unique'] for i in
+                   sqlalchemy.inspect(engine).get_indexes('messages')}
+        self.assertTrue(indexes['ix_messages_channel_id_ts'])
+        session.close()
+
+        # nothing should change on the second run
+        db.connect(self.dbname)
+        session = db.Session()
+        self.assertEqual(session.query(o.Message).count(), 2)
+        session.close()
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbname = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.dbname + suffix):
+                os.unlink(self.dbname + suffix)
+
+    def test_performance(self):
+        engine = db.connect(self.dbname)
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(),
+                         'wal')
+        self.assertEqual(engine.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(engine.execute('PRAGMA temp_store').scalar(), 2)
+        self.assertEqual(engine.execute('PRAGMA cache_size').scalar(),
+                         -65536)
+        engine.dispose()
+
+    def test_safe(self):
+        engine = db.connect(self.dbname, 'safe')
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(),
+                         'delete')
+        self.assertEqual(engine.execute('PRAGMA synchronous').scalar(), 2)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    unittest.main()
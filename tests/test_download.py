@@ -0,0 +1,310 @@
+import hashlib
+from http import server
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from slack_backup import download
+
+
+URL = 'https://files.slack.com/files-pri/T0000TEST-F00000001/download/img.jpg'
+URL1 = 'https://example.com/foo/img.jpg'
+URL2 = 'https://example.org/bar/img.jpg'
+URL3 = 'https://example.net/baz/img.jpg'
+FOO_SHA = '2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae'
+
+
+class FakeArgs(object):
+    team = 'fake_team'
+    user = 'fake_user'
+    password = 'fake_password'
+    download_jobs = 0
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dl = download.Download(FakeArgs(), self._tmpdir.name)
+        self.dl._authorized = True
+        self.content = {}
+
+        def _download(url, local, headers=None):
+            if url not in self.content:
+                raise requests.exceptions.ConnectionError()
+            with open(local, 'wb') as fobj:
+                fobj.write(self.content[url])
+            return (None, hashlib.sha256(self.content[url]).hexdigest(),
+                    len(self.content[url]))
+
+        self.dl._download = _download
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _read(self, path):
+        with open(path, 'rb') as fobj:
+            return fobj.read()
+
+    def test_download(self):
+        self.content[URL] = b'foo'
+        path = self.dl.download(URL, 'file')
+
+        self.assertEqual(path, os.path.join(self._tmpdir.name, 'files',
+                                            'T0000TEST-F00000001', 'img.jpg'))
+        self.assertEqual(self._read(path), b'foo')
+        self.assertListEqual(self.dl.get_results(),
+                             [download.Result(path, path, 'done', URL,
+                                              FOO_SHA, 3)])
+        self.assertListEqual(self.dl.get_results(), [])
+
+    def test_same_name(self):
+        self.content[URL1] = b'foo'
+        self.content[URL2] = b'foo'
+        path1 = self.dl.download(URL1, 'file')
+        path2 = self.dl.download(URL2, 'file')
+
+        self.assertNotEqual(path1, path2)
+        self.assertListEqual([(r.path, r.final) for r in
+                              self.dl.get_results()],
+                             [(path1, path1), (path2, path1)])
+        self.assertFalse(os.path.exists(path2))
+
+        self.content[URL3] = b'bar'
+        path3 = self.dl.download(URL3, 'file')
+        self.assertNotIn(path3, (path1, path2))
+        self.assertListEqual([(r.path, r.final) for r in
+                              self.dl.get_results()], [(path3, path3)])
+        self.assertEqual(self._read(path1), b'foo')
+        self.assertEqual(self._read(path3), b'bar')
+
+    def test_same_url(self):
+        self.content[URL] = b'foo'
+        path1 = self.dl.download(URL, 'file')
+        self.content[URL] = b'bar'
+        path2 = self.dl.download(URL, 'file')
+
+        self.assertEqual(path1, path2)
+        self.assertEqual(self._read(path1), b'foo')
+        self.assertListEqual(self.dl.get_results(),
+                             [download.Result(path1, path1, 'done', URL,
+                                              FOO_SHA, 3),
+                              download.Result(path1, path1, 'done', URL,
+                                              FOO_SHA, 3)])
+
+    def test_known_assets(self):
+        stored = os.path.join(self._tmpdir.name, 'stored.jpg')
+        self.dl.add_assets([(URL1, FOO_SHA, 3, stored)])
+
+        self.assertEqual(self.dl.download(URL1, 'file'), stored)
+
+        # the same content from the other url is not stored again
+        self.content[URL] = b'foo'
+        path = self.dl.download(URL, 'file')
+        self.assertFalse(os.path.exists(path))
+        self.assertListEqual([(r.path, r.final) for r in
+                              self.dl.get_results()],
+                             [(stored, stored), (path, stored)])
+
+    def test_failed(self):
+        path = self.dl.download(URL, 'file')
+        self.assertListEqual(self.dl.get_results(),
+                             [download.Result(path, path, 'failed', URL,
+                                              None, None)])
+        self.assertFalse(os.path.exists(path))
+
+    def test_background(self):
+        self.dl.jobs = 2
+        paths = []
+        for num in range(5):
+            url = URL.replace('img.jpg', 'img%d.jpg' % num)
+            self.content[url] = b'foo%d' % num
+            paths.append(self.dl.download(url, 'file'))
+
+        self.dl.wait()
+
+        self.assertListEqual(sorted((r.path, r.final, r.status)
+                                    for r in self.dl.get_results()),
+                             sorted((p, p, 'done') for p in paths))
+        for num, path in enumerate(paths):
+            self.assertEqual(self._read(path), b'foo%d' % num)
+
+    def test_hash_while_downloading(self):
+        dl = download.Download(FakeArgs(), self._tmpdir.name)
+        dl.chunk_size = 2
+        dl.session = mock.MagicMock()
+        response = dl.session.get.return_value
+        response.iter_content.return_value = [b'fo', b'o']
+        local = os.path.join(self._tmpdir.name, 'local')
+
+        self.assertEqual(dl._download(URL, local), (response, FOO_SHA, 3))
+        response.iter_content.assert_called_once_with(chunk_size=2)
+        self.assertEqual(self._read(local), b'foo')
+
+    def test_resume(self):
+        dl = download.Download(FakeArgs(), self._tmpdir.name)
+        dl.session = mock.MagicMock()
+        response = dl.session.get.return_value
+        response.status_code = 206
+        response.headers = {'Content-Range': 'bytes 2-2/3'}
+        response.iter_content.return_value = [b'o']
+        local = os.path.join(self._tmpdir.name, 'local')
+        with open(local, 'wb') as fobj:
+            fobj.write(b'fo')
+
+        self.assertEqual(dl._download(URL, local), (response, FOO_SHA, 3))
+        self.assertDictEqual(dl.session.get.call_args[1]['headers'],
+                             {'Range': 'bytes=2-'})
+        self.assertEqual(self._read(local), b'foo')
+
+    def test_resume_not_supported(self):
+        dl = download.Download(FakeArgs(), self._tmpdir.name)
+        dl.session = mock.MagicMock()
+        response = dl.session.get.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'foo']
+        local = os.path.join(self._tmpdir.name, 'local')
+        with open(local, 'wb') as fobj:
+            fobj.write(b'ba')
+
+        self.assertEqual(dl._download(URL, local), (response, FOO_SHA, 3))
+        self.assertEqual(self._read(local), b'foo')
+
+    def test_keep_partial(self):
+        def _download(url, local, headers=None):
+            with open(local, 'ab') as fobj:
+                fobj.write(b'fo')
+            raise requests.exceptions.ConnectionError()
+
+        self.dl._download = _download
+        self.dl.download(URL, 'file')
+        self.assertEqual(self.dl.get_results()[0].status, 'failed')
+        partial = self.dl._get_partial(URL)
+        self.assertEqual(self._read(partial), b'fo')
+        self.dl._partials.clear()
+
+    def test_connection_reuse(self):
+        class Handler(server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '3')
+                self.end_headers()
+                self.wfile.write(b'foo')
+
+            def log_message(self, *args):
+                pass
+
+        httpd = server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            self.dl.session = self.dl._new_session()
+            url = 'http://127.0.0.1:%d/file.jpg' % httpd.server_port
+            for _ in range(3):
+                local = os.path.join(self._tmpdir.name, 'local')
+                download.Download._download(self.dl, url, local)
+                self.assertEqual(self._read(local), b'foo')
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+        self.assertEqual(self.dl.get_stats(), (3, 1))
+
+    def test_not_authorized(self):
+        self.dl._authorized = False
+        self.assertIsNone(self.dl.download(URL, 'file'))
+        self.assertListEqual(self.dl.get_results(), [])
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(response=response)
+
+
+class FakeDownloader(object):
+    def __init__(self, errors):
+        self.clock = FakeClock()
+        self.breaker = download.CircuitBreaker(threshold=3, pause=10,
+                                               clock=self.clock,
+                                               sleep=self.clock.sleep)
+        self.session = 'session'
+        self.reauthorize = mock.MagicMock()
+        self.errors = list(errors)
+        self.calls = 0
+
+    @download.retry(3)
+    def get(self, url):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+@mock.patch('slack_backup.download.time.sleep')
+class TestRetry(unittest.TestCase):
+
+    def test_transient_error(self, sleep):
+        obj = FakeDownloader([requests.exceptions.ConnectionError()])
+        self.assertEqual(obj.get(URL), 'ok')
+        self.assertEqual(obj.calls, 2)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertLessEqual(sleep.call_args[0][0], download.BACKOFF_BASE)
+        obj.reauthorize.assert_not_called()
+
+    def test_give_up(self, sleep):
+        obj = FakeDownloader([requests.exceptions.Timeout()] * 3)
+        self.assertRaises(requests.exceptions.Timeout, obj.get, URL)
+        self.assertEqual(obj.calls, 3)
+
+    def test_not_found(self, sleep):
+        obj = FakeDownloader([_http_error(404)])
+        self.assertRaises(requests.exceptions.HTTPError, obj.get, URL)
+        self.assertEqual(obj.calls, 1)
+        sleep.assert_not_called()
+
+    def test_unauthorized(self, sleep):
+        obj = FakeDownloader([_http_error(401)])
+        self.assertEqual(obj.get(URL), 'ok')
+        obj.reauthorize.assert_called_once_with('session')
+
+    def test_retry_after(self, sleep):
+        obj = FakeDownloader([_http_error(429, {'Retry-After': '7'})])
+        self.assertEqual(obj.get(URL), 'ok')
+        sleep.assert_not_called()
+        self.assertListEqual(obj.clock.sleeps, [7])
+
+    def test_circuit_breaker(self, sleep):
+        obj = FakeDownloader([])
+        for _ in range(3):
+            obj.breaker.failure()
+        self.assertEqual(obj.get(URL), 'ok')
+        self.assertListEqual(obj.clock.sleeps, [10])
+
+
+if __name__ == "__main__":
+    unittest.main()
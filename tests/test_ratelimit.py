@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+
+from slack_backup import ratelimit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = ratelimit.TokenBucket(60, capacity=2, clock=self.clock,
+                                            sleep=self.clock.sleep)
+
+    def test_burst(self):
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.assertListEqual(self.clock.sleeps, [])
+
+        self.bucket.acquire()
+        self.assertListEqual(self.clock.sleeps, [1.0])
+
+    def test_refill(self):
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.clock.now += 10
+
+        self.bucket.acquire()
+        self.bucket.acquire()
+        self.assertListEqual(self.clock.sleeps, [])
+
+    def test_block(self):
+        self.bucket.block(5)
+        self.bucket.acquire()
+        self.assertEqual(self.clock.now, 105.0)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.slack = mock.MagicMock()
+        self.scheduler = ratelimit.Scheduler(self.slack, clock=self.clock,
+                                             sleep=self.clock.sleep)
+
+    def test_api_call(self):
+        self.slack.api_call.return_value = {'ok': True}
+        self.assertDictEqual(self.scheduler.api_call('users.list'),
+                             {'ok': True})
+        self.slack.api_call.assert_called_once_with('users.list')
+
+    def test_ratelimited(self):
+        limited = {'ok': False, 'error': 'ratelimited',
+                   'headers': {'Retry-After': '7'}}
+        self.slack.api_call.side_effect = [limited, {'ok': True}]
+
+        result = self.scheduler.api_call('channels.history', channel='C1')
+
+        self.assertDictEqual(result, {'ok': True})
+        self.assertEqual(self.slack.api_call.call_count, 2)
+        self.assertEqual(self.clock.now, 107.0)
+
+    def test_other_errors_are_not_repeated(self):
+        self.slack.api_call.return_value = {'ok': False,
+                                            'error': 'channel_not_found'}
+        result = self.scheduler.api_call('channels.history', channel='C1')
+
+        self.assertEqual(result['error'], 'channel_not_found')
+        self.assertEqual(self.slack.api_call.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
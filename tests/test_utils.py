@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from slack_backup import utils
+
+
+class TestFiles(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self._tmpdir.name, name)
+        with open(path, 'wb') as fobj:
+            fobj.write(content)
+        return path
+
+    def test_same_files(self):
+        content = b'x' * (utils.CHUNK_SIZE * 2 + 1)
+        path1 = self._write('file1', content)
+        path2 = self._write('file2', content)
+        path3 = self._write('file3', content[:-1] + b'y')
+        path4 = self._write('file4', content[:-1])
+
+        self.assertTrue(utils.same_files(path1, path2))
+        self.assertFalse(utils.same_files(path1, path3))
+        self.assertFalse(utils.same_files(path1, path4))
+
+    def test_cached_digest(self):
+        path = self._write('file', b'foo')
+        digest = utils.file_digest(path)
+
+        self.assertEqual(utils.cached_digest(path), digest)
+        self.assertTrue(os.path.exists(os.path.join(self._tmpdir.name,
+                                                    '.file.sha256')))
+
+        # digest is taken from the sidecar, as long as file is unchanged
+        utils.store_digest(path, 'cached')
+        self.assertEqual(utils.cached_digest(path), 'cached')
+
+        self._write('file', b'bar1')
+        self.assertEqual(utils.cached_digest(path),
+                         utils.file_digest(path))
+
+
+if __name__ == "__main__":
+    unittest.main()